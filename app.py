@@ -1,4 +1,5 @@
 ﻿import os
+import hashlib
 import zipfile
 import tempfile
 import shutil
@@ -11,30 +12,29 @@ from utils.file_utils import save_uploaded_zip, create_upgraded_zip, extract_dif
 
 
 # --- Check Azure OpenAI credentials ---
-def check_azure_connection():
-    from openai import AzureOpenAI
-    try:
-        # Load from Streamlit secrets or env vars
-        api_key = st.secrets.get("AZURE_OPENAI_API_KEY", os.getenv("AZURE_OPENAI_API_KEY"))
-        endpoint = st.secrets.get("AZURE_OPENAI_ENDPOINT", os.getenv("AZURE_OPENAI_ENDPOINT"))
-        deployment = st.secrets.get("AZURE_OPENAI_MODEL_DEPLOYMENT_NAME", os.getenv("AZURE_OPENAI_MODEL_DEPLOYMENT_NAME"))
-
-        if not (api_key and endpoint and deployment):
-            st.warning("⚠️ Azure OpenAI credentials not set. Please add them in Streamlit Secrets.")
-            return False
-
-        # Test connection
-        client = AzureOpenAI(api_key=api_key, azure_endpoint=endpoint, api_version="2024-08-01-preview")
-        client.models.list()  # simple call
-        st.success(f"🔒 Connected to Azure OpenAI — Model: `{deployment}`")
-        return True
-    except Exception as e:
-        st.error(f"❌ Azure connection failed: {e}")
-        return False
+# no network call here: listing deployments cost hundreds of ms on every
+# rerun, and auth errors surface on the first real completion anyway
+@st.cache_resource(show_spinner=False)
+def check_azure_connection(api_key_hash, endpoint, deployment):
+    return bool(api_key_hash and endpoint and deployment)
 
 
 # --- Run connection check before rest of UI loads ---
-check_azure_connection()
+# Load from Streamlit secrets or env vars
+_api_key = st.secrets.get("AZURE_OPENAI_API_KEY", os.getenv("AZURE_OPENAI_API_KEY"))
+_endpoint = st.secrets.get("AZURE_OPENAI_ENDPOINT", os.getenv("AZURE_OPENAI_ENDPOINT"))
+_deployment = st.secrets.get("AZURE_OPENAI_MODEL_DEPLOYMENT_NAME", os.getenv("AZURE_OPENAI_MODEL_DEPLOYMENT_NAME"))
+if check_azure_connection(hashlib.sha1((_api_key or "").encode()).hexdigest() if _api_key else "", _endpoint, _deployment):
+    st.success(f"🔒 Azure OpenAI configured — Model: `{_deployment}`")
+else:
+    st.warning("⚠️ Azure OpenAI credentials not set. Please add them in Streamlit Secrets.")
+
+# parse each upgrade preview once per content hash; the underscore keeps
+# Streamlit from re-hashing the full preview text on every rerun
+@st.cache_data(show_spinner=False)
+def _parse_preview_diffs(preview_sha1, _text):
+    return extract_diffs_from_markdown(_text)
+
 
 st.title("AI .NET Upgrader — LangGraph Edition")
 
@@ -54,7 +54,11 @@ if uploaded:
         with st.spinner("Running LangGraph pipeline..."):
             state = {"uploaded_file_path": project_root, "target_version": target_version}
             if private_feed: state["user_feed_url"] = private_feed
-            result = run_graph_invoke(graph, state)
+            # thread_id keyed on the upload itself: the mkdtemp extraction dir
+            # changes on every rerun, so hashing the path would give a fresh
+            # thread each click and checkpoint replay could never kick in
+            config = {"configurable": {"thread_id": hashlib.sha1(f"{uploaded.name}:{uploaded.size}".encode()).hexdigest()}}
+            result = run_graph_invoke(graph, state, config=config)
 
         st.success("✅ Analysis complete.")
 
@@ -62,8 +66,9 @@ if uploaded:
         with st.expander("📦 Package Report", expanded=False): st.json(result.get("package_report", {}))
         with st.expander("🧠 AI Analysis Report", expanded=False): st.markdown(result.get("analysis_report", "_No report returned_"))
         with st.expander("⚙️ Upgrade Preview", expanded=False):
-            st.markdown(result.get("upgrade_preview", "_No preview returned_"))
-            diffs = extract_diffs_from_markdown(result.get("upgrade_preview", ""))
+            preview = result.get("upgrade_preview", "")
+            st.markdown(preview or "_No preview returned_")
+            diffs = _parse_preview_diffs(hashlib.sha1(preview.encode()).hexdigest(), preview)
             if diffs:
                 for fname, before, after in diffs:
                     st.subheader(fname)
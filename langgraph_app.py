@@ -1,7 +1,7 @@
-﻿import os, json, re, tempfile, zipfile
-from typing import TypedDict, Optional, Dict, Any
-from dotenv import load_dotenv
-import streamlit as st 
+﻿import io, os, json, re, asyncio, tempfile, zipfile
+import operator
+from typing import TypedDict, Optional, Dict, Any, Annotated
+import streamlit as st
 try:
     from langgraph.graph import StateGraph, START, END
 except Exception:
@@ -10,9 +10,22 @@ except Exception:
     except Exception:
         raise
 
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI
+try:
+    from lxml import etree
+except Exception:
+    etree = None
+try:
+    from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+except Exception:
+    AsyncSqliteSaver = None
+try:
+    import tiktoken
+    _ENC = tiktoken.encoding_for_model("gpt-4o")
+except Exception:
+    _ENC = None
 
-from utils.nuget_helper import detect_private_feeds, generate_jwt_token_for_feed, get_latest_nuget_version_for_feed, collect_csproj_files, read_text
+from utils.nuget_helper import detect_private_feeds, feed_requires_auth, generate_jwt_token_for_feed, aget_latest_nuget_version_for_feed, collect_csproj_files, read_text
 from utils.file_utils import extract_diffs_from_markdown
 # --- Load Azure credentials from Streamlit Secrets or env vars ---
 AZURE_API_KEY = st.secrets.get("AZURE_OPENAI_API_KEY", os.getenv("AZURE_OPENAI_API_KEY"))
@@ -23,37 +36,57 @@ if not (AZURE_API_KEY and AZURE_ENDPOINT and AZURE_DEPLOYMENT):
     st.error("❌ Missing Azure OpenAI credentials. Please add them to Streamlit Secrets.")
     st.stop()
     
-client = AzureOpenAI(api_key=AZURE_API_KEY, api_version=os.getenv("AZURE_OPENAI_API_VERSION"), azure_endpoint=AZURE_ENDPOINT)
+# one client per event loop: each Start Analysis click runs under its own
+# asyncio.run loop, and pooled keepalive connections bound to a closed loop
+# raise "Event loop is closed" on the next use — so the client cannot be
+# cached across runs, only within one
+_ACLIENT = None
+_ACLIENT_LOOP = None
+
+def _get_aclient():
+    global _ACLIENT, _ACLIENT_LOOP
+    loop = asyncio.get_running_loop()
+    if _ACLIENT is None or _ACLIENT_LOOP is not loop:
+        _ACLIENT = AsyncAzureOpenAI(api_key=AZURE_API_KEY, api_version=os.getenv("AZURE_OPENAI_API_VERSION"), azure_endpoint=AZURE_ENDPOINT)
+        _ACLIENT_LOOP = loop
+    return _ACLIENT
+
 deployment = AZURE_DEPLOYMENT
 
+# precompiled once at import instead of per node invocation
+_PKG_RE = re.compile(r'<PackageReference\s+Include="([^"]+)"\s+Version="([^"]+)"')
+_FILE_BLOCK_RE = re.compile(r"--FILE:\s*(.*?)\s*--\n(.*?)--END FILE--", re.S)
+
 # State schema
 class UpgradeState(TypedDict, total=False):
     uploaded_file_path: str
     user_feed_url: str
     private_feeds: list
-    feed_tokens: dict
+    # dict-merge reducers: gen_jwt and scan_pkgs run in the same superstep,
+    # so their channels must tolerate concurrent writes
+    feed_tokens: Annotated[dict, operator.or_]
     csproj_paths: list
-    package_report: dict
+    csproj_texts: dict
+    csprojs_text: str
+    package_report: Annotated[dict, operator.or_]
     analysis_report: str
     upgrade_preview: str
     csproj_updates: dict
     target_version: str
 
-# Create StateGraph (langgraph >=0.0.42 style)
-try:
-    graph = StateGraph(UpgradeState)
-except TypeError:
-    # older versions
-    graph = StateGraph()
-
 # --- Node implementations ---
+# every node returns only the keys it computed: nodes sharing a superstep
+# (gen_jwt / scan_pkgs) would otherwise both write the untouched channels and
+# raise InvalidUpdateError ("Can receive only one value per step")
 def upload_node(state: UpgradeState) -> UpgradeState:
     # state contains uploaded_file_path already (extracted by app)
     root = state["uploaded_file_path"]
-    state["csproj_paths"] = collect_csproj_files(root)
-    return state
+    csproj_paths = collect_csproj_files(root)
+    # read each csproj exactly once; scan and prompt assembly reuse these texts
+    return {"csproj_paths": csproj_paths,
+            "csproj_texts": {p: read_text(p) for p in csproj_paths}}
 
-def detect_feeds_node(state: UpgradeState) -> UpgradeState:
+async def detect_feeds_node(state: UpgradeState) -> UpgradeState:
     root = state["uploaded_file_path"]
     # if user provided feed, prefer that
     feeds = []
@@ -61,37 +94,104 @@ def detect_feeds_node(state: UpgradeState) -> UpgradeState:
         feeds = [state["user_feed_url"]]
     else:
         feeds = detect_private_feeds(root)
-    state["private_feeds"] = feeds
-    return state
+    return {"private_feeds": feeds}
 
-def generate_jwt_node(state: UpgradeState) -> UpgradeState:
+async def generate_jwt_node(state: UpgradeState) -> UpgradeState:
     tokens = {}
     for feed in state.get("private_feeds", []):
-        # generate ephemeral jwt; secret can be stored or generated per feed
-        jwt = generate_jwt_token_for_feed(feed)
-        tokens[feed] = jwt
-    state["feed_tokens"] = tokens
-    return state
-
-def scan_packages_node(state: UpgradeState) -> UpgradeState:
+        # skip anonymous feeds; lookups mint a token lazily on the first 401/403.
+        # the probe is a blocking requests call, so keep it off the event loop
+        # or it stalls the scan_pkgs branch running in the same superstep
+        if await asyncio.to_thread(feed_requires_auth, feed):
+            # generate ephemeral jwt; secret can be stored or generated per feed
+            tokens[feed] = generate_jwt_token_for_feed(feed)
+    return {"feed_tokens": tokens}
+
+def _iter_package_refs(text):
+    # streaming XML parse; also catches <Version> child elements the regex misses
+    if etree is not None:
+        try:
+            for _, elt in etree.iterparse(io.BytesIO(text.encode()), tag="{*}PackageReference"):
+                name = elt.get("Include") or elt.get("Update")
+                ver = elt.get("Version") or (elt.findtext("{*}Version") or "")
+                if name and ver:
+                    yield name, ver
+                elt.clear()
+            return
+        except Exception:
+            pass
+    # malformed XML (or no lxml): fall back to the regex scan
+    yield from _PKG_RE.findall(text)
+
+async def scan_packages_node(state: UpgradeState) -> UpgradeState:
     root = state["uploaded_file_path"]
     csprojs = state.get("csproj_paths", []) or collect_csproj_files(root)
-    pkgs = {}
-    for p in csprojs:
-        text = read_text(p)
-        for name, ver in re.findall(r'<PackageReference\s+Include="([^"]+)"\s+Version="([^"]+)"', text):
-            # fetch latest using private feed token if present
-            feed = (state.get("private_feeds") or [None])[0]  # single feed support
-            token = state.get("feed_tokens", {}).get(feed)
-            latest = get_latest_nuget_version_for_feed(name, feed, token)
-            pkgs.setdefault(name, {"current": ver})
-            pkgs[name]["latest"] = latest
-    state["package_report"] = pkgs
-    return state
-
-def analyze_ai_node(state: UpgradeState) -> UpgradeState:
-    # Use your exact prompt (verbatim) — include context
-    user_prompt = """1. Private NuGet Feed Support
+    feed = (state.get("private_feeds") or [None])[0]  # single feed support
+    token = state.get("feed_tokens", {}).get(feed)
+    texts = state.get("csproj_texts") or {p: read_text(p) for p in csprojs}
+    # collect unique package references first, then fan out the lookups
+    unique = {}
+    for text in texts.values():
+        for name, ver in _iter_package_refs(text):
+            if "$(" in name:
+                continue  # MSBuild property reference — no feed can resolve it
+            unique.setdefault(name, ver)
+    # all lookups multiplexed over one HTTP/2 connection per host
+    names = list(unique)
+    latests = await asyncio.gather(*[aget_latest_nuget_version_for_feed(n, feed, token) for n in names])
+    return {"package_report": {n: {"current": unique[n], "latest": latest} for n, latest in zip(names, latests)}}
+
+# keep prompts comfortably inside the model context (minus scaffolding + completion)
+_MAX_PROMPT_TOKENS = 100000
+
+def _token_len(text: str) -> int:
+    if _ENC is not None:
+        return len(_ENC.encode(text))
+    return len(text) // 4  # ~4 chars/token heuristic when tiktoken is absent
+
+def _collect_csprojs_text(state: UpgradeState) -> str:
+    # assembled at most once per run; list+join is linear in total bytes
+    # where repeated += degrades to quadratic on multi-MB bundles
+    cached = state.get("csprojs_text")
+    if cached is not None:
+        return cached
+    root = state["uploaded_file_path"]
+    paths = state.get("csproj_paths", [])
+    texts = state.get("csproj_texts", {})
+    parts = []
+    for p in paths:
+        rel = os.path.relpath(p, root)
+        parts.append(f"// FILE: {rel}\n")
+        parts.append(texts.get(p) or read_text(p))
+        parts.append("\n\n")
+    csprojs_text = "".join(parts)
+    if _token_len(csprojs_text) > _MAX_PROMPT_TOKENS:
+        # over budget: drop generated/build csprojs first, cap the rest at 200 lines
+        keep = [p for p in paths if not any(seg in ("bin", "obj", "Properties") for seg in p.split(os.sep))]
+        parts = []
+        for p in keep:
+            rel = os.path.relpath(p, root)
+            body = "\n".join((texts.get(p) or read_text(p)).splitlines()[:200])
+            parts.append(f"// FILE: {rel}\n")
+            parts.append(body)
+            parts.append("\n\n")
+        csprojs_text = "".join(parts)
+    return csprojs_text
+
+async def _stream_completion(messages, max_tokens: int, label: str) -> str:
+    # render tokens as they arrive so the user is not blocked on the full response
+    placeholder = st.empty()
+    buf = ""
+    stream = await _get_aclient().chat.completions.create(model=deployment, messages=messages, max_tokens=max_tokens, stream=True)
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            buf += chunk.choices[0].delta.content
+            placeholder.markdown(f"**{label}** (streaming)...\n\n" + buf)
+    placeholder.empty()
+    return buf
+
+# Use your exact prompt (verbatim) — interned once at import
+_USER_PROMPT = """1. Private NuGet Feed Support
 
 Implement support for private NuGet feeds
 
@@ -123,26 +223,22 @@ setup
 
 In the report, list which packages can resolve these vulnerabilities"""
 
-    root = state["uploaded_file_path"]
-    csprojs_text = ""
-    for p in state.get("csproj_paths", []):
-        rel = os.path.relpath(p, root)
-        csprojs_text += f"// FILE: {rel}\n" + read_text(p) + "\n\n"
-    package_report_json = json.dumps(state.get("package_report", {}), indent=2)
-    prompt = f"""
+# static prompt scaffolding built once at import; only the variable slots
+# are formatted per call
+_ANALYZE_TEMPLATE = """
 You are an expert .NET upgrade assistant.
 
 User instructions (DO NOT CHANGE):
 {user_prompt}
 
 Context:
-- Target .NET version: {state.get('target_version')}
-- Private feeds: {json.dumps(state.get('private_feeds', []))}
+- Target .NET version: {target}
+- Private feeds: {feeds}
 - Package report (current -> latest):
-{package_report_json}
+{pkg}
 
 Project .csproj contents:
-{csprojs_text}
+{csprojs}
 
 Please produce a structured Markdown report covering:
 - Executive summary
@@ -152,19 +248,9 @@ Please produce a structured Markdown report covering:
 - Security vulnerability reporting and which packages resolve them
 - Final ordered automation plan (commands and csproj patches)
 """
-    resp = client.chat.completions.create(model=deployment, messages=[{"role":"user","content":prompt}], max_tokens=3000)
-    state["analysis_report"] = resp.choices[0].message.content
-    return state
 
-def upgrade_ai_node(state: UpgradeState) -> UpgradeState:
-    root = state["uploaded_file_path"]
-    csprojs_text = ""
-    for p in state.get("csproj_paths", []):
-        rel = os.path.relpath(p, root)
-        csprojs_text += f"// FILE: {rel}\n" + read_text(p) + "\n\n"
-
-    prompt = f"""
-Using the analysis and rules, produce UPDATED .csproj XML for each file to target {state.get('target_version')}.
+_UPGRADE_TEMPLATE = """
+Using the analysis and rules, produce UPDATED .csproj XML for each file to target {target}.
 - Do NOT auto-change private/third-party package versions; mark them 'Manual Review Required (Private Feed)'.
 - For public packages, update to latest stable when safe.
 - For deprecated packages, prefer recommended alternatives and include csproj patch.
@@ -173,61 +259,115 @@ Return output as machine-parseable blocks:
 --FILE: relative/path/to/Proj.csproj --
 <full updated csproj xml>
 --END FILE--
-"""
-    resp = client.chat.completions.create(model=deployment, messages=[{"role":"user","content":prompt + "\n\n" + csprojs_text}], max_tokens=3500)
-    preview = resp.choices[0].message.content
-    state["upgrade_preview"] = preview
 
+
+{csprojs}"""
+
+def _build_analysis_prompt(state: UpgradeState, csprojs_text: str = None) -> str:
+    if csprojs_text is None:
+        csprojs_text = _collect_csprojs_text(state)
+    return _ANALYZE_TEMPLATE.format(
+        user_prompt=_USER_PROMPT,
+        target=state.get("target_version"),
+        feeds=json.dumps(state.get("private_feeds", [])),
+        pkg=json.dumps(state.get("package_report", {}), indent=2),
+        csprojs=csprojs_text,
+    )
+
+def _build_upgrade_prompt(state: UpgradeState, csprojs_text: str = None) -> str:
+    if csprojs_text is None:
+        csprojs_text = _collect_csprojs_text(state)
+    return _UPGRADE_TEMPLATE.format(target=state.get("target_version"), csprojs=csprojs_text)
+
+def _parse_upgrade_preview(preview: str) -> dict:
     # Parse preview into csproj_updates mapping
     csproj_updates = {}
-    for m in re.finditer(r"--FILE:\s*(.*?)\s*--\n(.*?)--END FILE--", preview, re.S):
+    for m in _FILE_BLOCK_RE.finditer(preview):
         rel = m.group(1).strip()
         xml = m.group(2).strip()
         csproj_updates[rel] = xml
-    state["csproj_updates"] = csproj_updates
-    return state
+    return {"upgrade_preview": preview, "csproj_updates": csproj_updates}
+
+async def analyze_and_upgrade_node(state: UpgradeState) -> UpgradeState:
+    # The upgrade prompt does not depend on the analysis output, so both
+    # completions can be in flight at once — halves the LLM wall-clock cost.
+    # csprojs_text is assembled (and token-trimmed) once and shared by both prompts.
+    csprojs_text = _collect_csprojs_text(state)
+    analysis, upgrade = await asyncio.gather(
+        _stream_completion([{"role":"user","content":_build_analysis_prompt(state, csprojs_text)}], 1800, "AI Analysis"),
+        _stream_completion([{"role":"user","content":_build_upgrade_prompt(state, csprojs_text)}], 1800, "Upgrade Preview"),
+    )
+    delta = _parse_upgrade_preview(upgrade)
+    delta["analysis_report"] = analysis
+    delta["csprojs_text"] = csprojs_text
+    return delta
 
 def final_node(state: UpgradeState) -> UpgradeState:
     # nothing special; pass through
-    return state
-
-# --- register nodes and edges ---
-try:
-    graph.add_node("upload", upload_node)
-    graph.add_node("detect_feeds", detect_feeds_node)
-    graph.add_node("gen_jwt", generate_jwt_node)
-    graph.add_node("scan_pkgs", scan_packages_node)
-    graph.add_node("analyze_ai", analyze_ai_node)
-    graph.add_node("upgrade_ai", upgrade_ai_node)
-    graph.add_node("final", final_node)
-    graph.set_entry_point("upload")
-    graph.add_edge("upload", "detect_feeds")
-    graph.add_edge("detect_feeds", "gen_jwt")
-    graph.add_edge("gen_jwt", "scan_pkgs")
-    graph.add_edge("scan_pkgs", "analyze_ai")
-    graph.add_edge("analyze_ai", "upgrade_ai")
-    graph.add_edge("upgrade_ai", "final")
-except Exception:
-    # if graph API differs, you might need to adapt to your langgraph version
-    pass
+    return {}
 
-# helper to run the graph from Streamlit app
+# helper to build the graph once per process; cache_resource keeps the
+# compiled graph across Streamlit reruns instead of re-registering nodes
+@st.cache_resource
 def build_graph():
-    return graph
-
-def run_graph_invoke(graph_obj, initial_state: dict) -> dict:
-    # Graph invoke APIs vary; try common ones
+    # Create StateGraph (langgraph >=0.0.42 style)
     try:
-        result = graph_obj.invoke(initial_state)
-        return result
-    except Exception:
-        # fallback: run nodes sequentially
-        state = initial_state.copy()
-        state = upload_node(state)
-        state = detect_feeds_node(state)
-        state = generate_jwt_node(state)
-        state = scan_packages_node(state)
-        state = analyze_ai_node(state)
-        state = upgrade_ai_node(state)
-        state = final_node(state)
-        return state
+        builder = StateGraph(UpgradeState)
+    except TypeError:
+        # older versions
+        builder = StateGraph()
+    builder.add_node("upload", upload_node)
+    builder.add_node("detect_feeds", detect_feeds_node)
+    builder.add_node("gen_jwt", generate_jwt_node)
+    builder.add_node("scan_pkgs", scan_packages_node)
+    builder.add_node("analyze_and_upgrade", analyze_and_upgrade_node)
+    builder.add_node("final", final_node)
+    builder.set_entry_point("upload")
+    builder.add_edge("upload", "detect_feeds")
+    # fan out: JWT issuance and NuGet scanning have no data dependency once
+    # feeds are known (lookups fall back to the public feed without a token)
+    builder.add_edge("detect_feeds", "gen_jwt")
+    builder.add_edge("detect_feeds", "scan_pkgs")
+    builder.add_edge(["gen_jwt", "scan_pkgs"], "analyze_and_upgrade")
+    builder.add_edge("analyze_and_upgrade", "final")
+    builder.add_edge("final", END)
+    # compiled without a checkpointer: the async saver can only exist inside
+    # a running event loop, so run_graph_invoke attaches one per run
+    return builder.compile()
+
+_CKPT_PATH = os.path.join(tempfile.gettempdir(), "upgrader_ckpt.db")
+
+def run_graph_invoke(graph_obj, initial_state: dict, config: dict = None) -> dict:
+    async def _arun():
+        # checkpoint to sqlite so a re-run with the same thread_id replays
+        # from the last successful node instead of re-issuing the Azure
+        # calls. The saver is created inside the running loop and closed on
+        # exit: its lock and aiosqlite connection are loop-bound (building it
+        # outside a loop raises "no running event loop"), and a leaked
+        # connection keeps the interpreter from exiting.
+        if AsyncSqliteSaver is not None and config is not None:
+            async with AsyncSqliteSaver.from_conn_string(_CKPT_PATH) as saver:
+                graph_obj.checkpointer = saver
+                try:
+                    return await graph_obj.ainvoke(initial_state, config=config)
+                finally:
+                    graph_obj.checkpointer = None
+        return await graph_obj.ainvoke(initial_state, config=config)
+
+    # Graph invoke APIs vary; only that API-variance case may fall back —
+    # a blanket except here once shipped a broken checkpointer undetected
+    try:
+        return asyncio.run(_arun())
+    except (AttributeError, TypeError, NotImplementedError) as e:
+        st.warning(f"⚠️ Graph invoke failed ({e!r}); running nodes sequentially without checkpointing.")
+        # fallback: run nodes sequentially, merging each node's delta
+        async def _run_sequential():
+            state = dict(initial_state)
+            state.update(upload_node(state))
+            state.update(await detect_feeds_node(state))
+            jwt_delta, scan_delta = await asyncio.gather(generate_jwt_node(state), scan_packages_node(state))
+            state.update(jwt_delta)
+            state.update(scan_delta)
+            state.update(await analyze_and_upgrade_node(state))
+            return state
+        return asyncio.run(_run_sequential())
@@ -1,18 +1,50 @@
-﻿import os, tempfile, zipfile, re
+﻿import os, shutil, tempfile, zipfile, re
+_FILE_BLOCK_RE = re.compile(r"--FILE:\s*(.*?)\s*--\n(.*?)--END FILE--", re.S)
+_BEFORE_RE = re.compile(r"<before>(.*?)</before>", re.S)
+_AFTER_RE = re.compile(r"<after>(.*?)</after>", re.S)
 def save_uploaded_zip(u):
-    t=tempfile.mkdtemp(); p=os.path.join(t,'upload.zip'); open(p,'wb').write(u.read())
-    import zipfile; zipfile.ZipFile(p).extractall(t); return t
-def create_upgraded_zip(root, updates, target):
+    # stream the upload to disk in 1 MiB chunks instead of buffering it all;
+    # the zip is kept next to the extracted tree for later repacking
+    t=tempfile.mkdtemp(); p=os.path.join(t,'upload.zip')
+    with open(p,'wb') as fh: shutil.copyfileobj(u, fh, length=1<<20)
+    with zipfile.ZipFile(p) as z: z.extractall(t)
+    return t
+_TF_RE = re.compile(r'<TargetFramework>.*?</TargetFramework>')
+def create_upgraded_zip(root, updates, target, compresslevel=None):
     zpath=os.path.join(tempfile.gettempdir(),f'AI_Upgraded_{target}.zip')
-    with zipfile.ZipFile(zpath,'w',zipfile.ZIP_DEFLATED) as z:
-        for r,_,fs in os.walk(root):
-            for f in fs:
-                src=os.path.join(r,f); rel=os.path.relpath(src,root)
-                if rel in updates: z.writestr(rel,updates[rel])
-                else:
-                    if rel.endswith('.csproj'):
-                        orig=open(src).read(); upd=re.sub(r'<TargetFramework>.*?</TargetFramework>',f'<TargetFramework>{target}</TargetFramework>',orig)
+    updates={k.replace('\\','/'):v for k,v in updates.items()}
+    src_zip=os.path.join(root,'upload.zip')
+    with zipfile.ZipFile(zpath,'w',zipfile.ZIP_DEFLATED,allowZip64=True,compresslevel=compresslevel) as z:
+        if os.path.exists(src_zip):
+            # copy unchanged entries straight out of the original archive so
+            # only modified files get re-read and re-compressed
+            with zipfile.ZipFile(src_zip) as src:
+                for info in src.infolist():
+                    rel=info.filename
+                    if rel.endswith('/'): continue
+                    if rel in updates: z.writestr(rel,updates[rel])
+                    elif rel.endswith('.csproj'):
+                        upd=_TF_RE.sub(f'<TargetFramework>{target}</TargetFramework>',src.read(info).decode('utf-8','ignore'))
+                        z.writestr(rel,upd)
+                    else:
+                        with src.open(info) as fh: z.writestr(info,fh.read())
+        else:
+            # fallback when the original zip is gone: walk the extracted tree
+            for r,_,fs in os.walk(root):
+                for f in fs:
+                    src=os.path.join(r,f); rel=os.path.relpath(src,root).replace('\\','/')
+                    if rel=='upload.zip': continue
+                    if rel in updates: z.writestr(rel,updates[rel])
+                    elif rel.endswith('.csproj'):
+                        orig=open(src).read(); upd=_TF_RE.sub(f'<TargetFramework>{target}</TargetFramework>',orig)
                         z.writestr(rel,upd)
                     else: z.write(src,rel)
     return zpath
-def extract_diffs_from_markdown(t): return []
+def extract_diffs_from_markdown(t):
+    """Extract (file, before, after) blocks from an AI upgrade preview."""
+    diffs=[]
+    for m in _FILE_BLOCK_RE.finditer(t):
+        fname=m.group(1).strip(); xml=m.group(2)
+        before=_BEFORE_RE.search(xml); after=_AFTER_RE.search(xml)
+        if before and after: diffs.append((fname, before.group(1).strip(), after.group(1).strip()))
+    return diffs
@@ -1,28 +1,110 @@
-﻿import os, re, requests, secrets, hashlib, time
-import jwt  # PyJWT
+﻿import os, re, asyncio, base64, functools, hmac, json, mmap, secrets, hashlib, tempfile, time
+import httpx
+try:
+    import jwt  # PyJWT — optional, only used when a real secret is supplied
+except Exception:
+    jwt = None
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-# helper to read files
+# shared pooled session so parallel lookups reuse TCP/TLS connections;
+# the sqlite backend persists NuGet index.json responses across runs
+_SESSION = requests_cache.CachedSession(
+    cache_name=os.path.join(tempfile.gettempdir(), "nuget_cache"),
+    backend="sqlite", expire_after=3600, allowable_methods=("GET",))
+_SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32,
+                                       max_retries=Retry(total=2, backoff_factor=0.2)))
+
+# async client multiplexes all lookups over one HTTP/2 connection per host,
+# avoiding a TLS handshake per worker thread. One client per event loop:
+# each pipeline run gets its own asyncio.run loop, and keepalive connections
+# bound to a closed loop raise "Event loop is closed" on the next run
+_ACLIENT = None
+_ACLIENT_LOOP = None
+
+def _get_async_client():
+    global _ACLIENT, _ACLIENT_LOOP
+    loop = asyncio.get_running_loop()
+    if _ACLIENT is None or _ACLIENT_LOOP is not loop:
+        _ACLIENT = httpx.AsyncClient(http2=True, timeout=6,
+                                     limits=httpx.Limits(max_connections=32, max_keepalive_connections=32))
+        _ACLIENT_LOOP = loop
+    return _ACLIENT
+
+# helper to read files; large files go through mmap so repeat reads across
+# nodes are served from the OS page cache without a buffered-IO copy
 def read_text(path):
-    with open(path, "r", encoding="utf-8", errors="ignore") as f:
-        return f.read()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        sz = os.fstat(fd).st_size
+        if sz == 0:
+            return ""
+        if sz < 4096:
+            # mmap setup isn't worth it for small files
+            return os.read(fd, sz).decode("utf-8", "ignore")
+        with mmap.mmap(fd, sz, access=mmap.ACCESS_READ) as mm:
+            return mm[:].decode("utf-8", "ignore")
+    finally:
+        os.close(fd)
+
+# build artifacts and VCS metadata never hold csproj/nuget.config we care about
+_PRUNE_DIRS = {"bin", "obj", ".git", "node_modules", "packages"}
+
+def _walk(root):
+    """Yield file DirEntry objects under root, skipping pruned directories."""
+    try:
+        entries = list(os.scandir(root))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if entry.name not in _PRUNE_DIRS:
+                yield from _walk(entry.path)
+        else:
+            yield entry
 
 def collect_csproj_files(root_dir):
-    out = []
-    for r, _, files in os.walk(root_dir):
-        for f in files:
-            if f.endswith(".csproj"):
-                out.append(os.path.join(r, f))
-    return out
+    return [e.path for e in _walk(root_dir) if e.name.endswith(".csproj")]
 
 def detect_private_feeds(project_root):
     feeds = []
-    for r, _, files in os.walk(project_root):
-        for f in files:
-            if f.lower() == "nuget.config":
-                txt = read_text(os.path.join(r, f))
-                feeds += re.findall(r'<add key=".*?" value="(.*?)"', txt)
+    for e in _walk(project_root):
+        if e.name.lower() == "nuget.config":
+            txt = read_text(e.path)
+            feeds += re.findall(r'<add key=".*?" value="(.*?)"', txt)
     return list(set(feeds))
 
+# anonymous feeds never need a bearer token, so don't mint one per run
+_PUBLIC_FEED_RE = re.compile(r'(^|\.)nuget\.org')
+
+@functools.lru_cache(maxsize=256)
+def feed_requires_auth(feed_url):
+    """True when a feed looks like it wants authentication (non-public and
+    not answering an unauthenticated probe). Memoized per feed URL — the
+    HEAD probe bypasses the GET-only response cache, so without this it
+    would be a fresh round trip on every run."""
+    if _PUBLIC_FEED_RE.search(feed_url):
+        return False
+    try:
+        r = _SESSION.head(feed_url, timeout=6)
+        if r.status_code < 400:
+            return False
+    except Exception:
+        pass
+    return True
+
+# pre-encoded {"alg":"HS256","typ":"JWT"} header shared by every token
+_JWT_HEADER = b'eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9'
+
+def _fast_jwt(payload: dict, secret: str) -> str:
+    # direct HMAC-SHA256 signing; skips PyJWT's JSON/validation overhead for
+    # ephemeral tokens that no real issuer ever verifies
+    p = base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).rstrip(b"=")
+    signing = _JWT_HEADER + b"." + p
+    sig = base64.urlsafe_b64encode(hmac.new(secret.encode(), signing, hashlib.sha256).digest()).rstrip(b"=")
+    return (signing + b"." + sig).decode()
+
 # JWT generator for feed auth (ephemeral)
 def generate_jwt_token_for_feed(feed_url: str, subject: str = "ai-upgrader", ttl_seconds: int = 300, secret: str = None):
     """
@@ -30,7 +112,8 @@ def generate_jwt_token_for_feed(feed_url: str, subject: str = "ai-upgrader", ttl
     If secret is None, we derive a random secret per feed (non-persisted).
     In production, replace with your real token issuance (Azure AD, etc.).
     """
-    if not secret:
+    ephemeral = not secret
+    if ephemeral:
         # derive deterministic-ish secret from feed_url + random salt
         salt = secrets.token_hex(8)
         secret = hashlib.sha256((feed_url + salt).encode()).hexdigest()
@@ -41,11 +124,77 @@ def generate_jwt_token_for_feed(feed_url: str, subject: str = "ai-upgrader", ttl
         "exp": now + ttl_seconds,
         "feed": feed_url
     }
-    token = jwt.encode(payload, secret, algorithm="HS256")
-    # return the token (and optionally the secret if you want to verify later)
-    return token
+    # production secrets go through PyJWT when present; throwaway tokens take
+    # the fast path
+    if not ephemeral and jwt is not None:
+        return jwt.encode(payload, secret, algorithm="HS256")
+    return _fast_jwt(payload, secret)
 
 def get_latest_nuget_version_for_feed(package_name: str, feed_url: str = None, token: str = None):
+    # cache key is (name, feed) only — the URL alone determines the response
+    # body, so the bearer token is kept out of the key via _FEED_TOKENS
+    if feed_url and token:
+        _FEED_TOKENS[feed_url] = token
+    return _latest_cached(package_name.lower(), feed_url or None)
+
+_FEED_TOKENS = {}
+
+@functools.lru_cache(maxsize=4096)
+def _latest_cached(package_name: str, feed_url: str = None):
+    return _fetch_latest_version(package_name, feed_url, _FEED_TOKENS.get(feed_url))
+
+def _pick_version(versions):
+    stable = [v for v in versions if "-" not in v]
+    return stable[-1] if stable else (versions[-1] if versions else None)
+
+async def aget_latest_nuget_version_for_feed(package_name: str, feed_url: str = None, token: str = None):
+    """Async variant of get_latest_nuget_version_for_feed; memoized per
+    (name, feed) with the same 1h expiry / 4096-entry bound as the sync path."""
+    key = (package_name.lower(), feed_url or None)
+    hit = _ALATEST_CACHE.get(key)
+    if hit is not None and time.time() - hit[1] < _ALATEST_TTL:
+        return hit[0]
+    if feed_url and token:
+        _FEED_TOKENS[feed_url] = token
+    latest = await _afetch_latest_version(key[0], feed_url, _FEED_TOKENS.get(feed_url))
+    if len(_ALATEST_CACHE) >= _ALATEST_MAX:
+        # evict oldest insertion; good enough for a bounded memo
+        _ALATEST_CACHE.pop(next(iter(_ALATEST_CACHE)))
+    _ALATEST_CACHE[key] = (latest, time.time())
+    return latest
+
+_ALATEST_CACHE = {}  # (name, feed) -> (latest, fetched_at)
+_ALATEST_TTL = 3600
+_ALATEST_MAX = 4096
+
+async def _afetch_latest_version(package_name: str, feed_url: str = None, token: str = None):
+    client = _get_async_client()
+    headers = {}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    # try private feed first
+    if feed_url:
+        try:
+            url = f"{feed_url.rstrip('/')}/v3-flatcontainer/{package_name}/index.json"
+            r = await client.get(url, headers=headers)
+            if r.status_code in (401, 403) and not token:
+                # feed wants auth after all: mint a token once, cache it, retry
+                token = _FEED_TOKENS.setdefault(feed_url, generate_jwt_token_for_feed(feed_url))
+                r = await client.get(url, headers={"Authorization": f"Bearer {token}"})
+            if r.status_code == 200:
+                return _pick_version(r.json().get("versions", []))
+        except Exception:
+            pass
+    # fallback to public
+    try:
+        r = await client.get(f"https://api.nuget.org/v3-flatcontainer/{package_name}/index.json")
+        if r.status_code == 200:
+            return _pick_version(r.json().get("versions", []))
+    except Exception:
+        pass
+    return None
+
+def _fetch_latest_version(package_name: str, feed_url: str = None, token: str = None):
     headers = {}
     if token:
         headers["Authorization"] = f"Bearer {token}"
@@ -53,21 +202,21 @@ def get_latest_nuget_version_for_feed(package_name: str, feed_url: str = None, t
     if feed_url:
         try:
             url = f"{feed_url.rstrip('/')}/v3-flatcontainer/{package_name.lower()}/index.json"
-            r = requests.get(url, headers=headers, timeout=6)
+            r = _SESSION.get(url, headers=headers, timeout=6)
+            if r.status_code in (401, 403) and not token:
+                # feed wants auth after all: mint a token once, cache it, retry
+                token = _FEED_TOKENS.setdefault(feed_url, generate_jwt_token_for_feed(feed_url))
+                r = _SESSION.get(url, headers={"Authorization": f"Bearer {token}"}, timeout=6)
             if r.status_code == 200:
-                versions = r.json().get("versions", [])
-                stable = [v for v in versions if "-" not in v]
-                return stable[-1] if stable else (versions[-1] if versions else None)
+                return _pick_version(r.json().get("versions", []))
         except Exception:
             pass
     # fallback to public
     try:
         url = f"https://api.nuget.org/v3-flatcontainer/{package_name.lower()}/index.json"
-        r = requests.get(url, timeout=6)
+        r = _SESSION.get(url, timeout=6)
         if r.status_code == 200:
-            versions = r.json().get("versions", [])
-            stable = [v for v in versions if "-" not in v]
-            return stable[-1] if stable else (versions[-1] if versions else None)
+            return _pick_version(r.json().get("versions", []))
     except Exception:
         pass
     return None